@@ -1,4 +1,10 @@
+import numpy as np
+
 SP_FILL = ' ' * 4
+# Maps a rhythm filter's pattern onto the string form of an empty rhythm
+_PATTERN_TO_EMPTY = str.maketrans('1X', '00')
+# The characters a rhythm filter's pattern may consist of
+_PATTERN_CHARS = frozenset('10X_')
 
 class RhythmFilter:
     """ 
@@ -11,12 +17,48 @@ class RhythmFilter:
         corresponding time signature and subdivision.
         - Be of the same length.
         - Contain either a 1 or 0 in place of an X.
+    The underscores and length are checked once, by fits(), when the filter
+    is attached to a RhythmCalculator; matching itself compares only bits, so
+    a filter must be attached before it is matched against rhythms. A
+    pattern with any other character never matches.
 
     Attributes:
         pattern (str): The beat pattern to be matched for this filter.
     """
     def __init__(self, pattern:str):
         self.pattern = pattern
+        self.compile_pattern()
+
+    def compile_pattern(self):
+        """
+        Precompile self's pattern into integer bitmasks so that a rhythm, in
+        its integer form, is matched with a single bitwise test. Bits are read
+        from most significant to least significant, as with rhythms.
+            care mask: bit set where the pattern is '1' or '0'
+            value mask: bit set where the pattern is '1'
+        Also record whether the pattern consists only of valid characters.
+        """
+        self._is_valid = _PATTERN_CHARS.issuperset(self.pattern)
+        undelimited = self.pattern.replace('_', '')
+        self._care_mask = 0
+        self._value_mask = 0
+        for c in undelimited:
+            self._care_mask <<= 1
+            self._value_mask <<= 1
+            if c == '1':
+                self._care_mask |= 1
+                self._value_mask |= 1
+            elif c == '0':
+                self._care_mask |= 1
+
+    def fits(self, empty_rhythm:str):
+        """
+        Return True if self's pattern is valid for rhythms of the same form as
+        param empty_rhythm, the string representation of a rhythm with no
+        events (e.g., '000_000'): it has the same length and underscores, and
+        otherwise consists only of '1', '0', and 'X'.
+        """
+        return self.pattern.translate(_PATTERN_TO_EMPTY) == empty_rhythm
 
     @classmethod
     def from_json(cls, as_json):
@@ -28,15 +70,24 @@ class RhythmFilter:
         """Return a serializable (for JSON) form of this instance."""
         return self.pattern
     
-    def matches(self, rhythm:str):
-        """Return True if param rhythm matches self's beat pattern."""
-        if (len(rhythm) != len(self.pattern)):
-            return False
-        matches = True
-        for (c1, c2) in zip(rhythm, self.pattern):
-            matches = matches and ((c1 == c2) or (c2 == 'X'))
-            pass
-        return matches
+    def matches(self, rhythm:int):
+        """
+        Return True if param rhythm, in integer form, matches self's beat
+        pattern. The rhythm's length isn't checked; see attach_filter in
+        RhythmCalculator.
+        """
+        return (self._is_valid and
+                ((rhythm ^ self._value_mask) & self._care_mask) == 0)
+
+    def matches_vec(self, rhythms:np.ndarray):
+        """
+        Return a boolean array marking which of param rhythms, in integer
+        form, match self's beat pattern. The rhythms' length isn't checked;
+        see attach_filter in RhythmCalculator.
+        """
+        if not self._is_valid:
+            return np.zeros(len(rhythms), dtype=bool)
+        return ((rhythms ^ self._value_mask) & self._care_mask) == 0
     
     def get_name(self):
         """Return a pretty name for this filter."""
@@ -74,6 +125,21 @@ class CalculationFilter:
     def matches(self, calculation:int):
         """Return True if param calculation matches self's filter."""
         return (calculation >= self.min and calculation <= self.max)
+
+    def matches_vec(self, calculations:np.ndarray, out:np.ndarray=None):
+        """
+        Return a boolean array marking which of param calculations match
+        self's filter. If the boolean array param out is given, it is instead
+        narrowed in place to the calculations that also match self's filter,
+        and returned.
+        """
+        if out is None:
+            return (calculations >= self.min) & (calculations <= self.max)
+        scratch = np.greater_equal(calculations, self.min)
+        np.logical_and(out, scratch, out=out)
+        np.less_equal(calculations, self.max, out=scratch)
+        np.logical_and(out, scratch, out=out)
+        return out
     
     def get_name(self):
         """Return a pretty name for this filter."""
@@ -92,7 +158,14 @@ class AndFilter:
     """
     def __init__(self):
         """Initialize empty AndFilter."""
+        self.rhythm_filter = None
         self.calc_filters = []
+        # Bumped whenever a sub-filter changes, invalidating _mask_cache
+        self._version = 0
+        # (version, rhythms, metrics, mask) of the last matches_vec
+        self._mask_cache = None
+        # (version, spaces_off, name) of the last get_name
+        self._name_cache = None
     
     @classmethod
     def from_rfilter(cls, rf:RhythmFilter):
@@ -115,7 +188,7 @@ class AndFilter:
     def get_serializable(self):
         """Return a serializable (for JSON) form of this instance."""
         self_dict = {}
-        if hasattr(self, 'rhythm_filter'):
+        if self.rhythm_filter is not None:
             self_dict['rhythm_filter'] = self.rhythm_filter.get_serializable()
         if self.calc_filters:
             self_dict['calc_filters'] = [cf.get_serializable() for cf in 
@@ -125,37 +198,79 @@ class AndFilter:
     def update_rhythm_filter(self, rf:RhythmFilter):
         """Assign a new rhythm filter to this instance."""
         self.rhythm_filter = rf
+        self._version += 1
         
     def add_calculation_filter(self, cf:CalculationFilter):
         self.calc_filters.append(cf)
+        self._version += 1
 
-    def matches(self, rhythm:str, calculations:list):
+    def matches(self, rhythm:int, calculations:list):
         """
         Return True if the given rhythm, and its calculations, match all of
         self's filters.
 
         Arguments:
-            rhythm (str): The string representation of a rhythm
+            rhythm (int): The integer representation of a rhythm
             calculations (list[int]): The calculated values associated with the
                 passed rhythm.
         """
-        matches = True
-        if hasattr(self, 'rhythm_filter'):
-            matches = matches and self.rhythm_filter.matches(rhythm)
-        if hasattr(self, 'calc_filters'):
-            for cf in self.calc_filters:
-                matches = matches and cf.matches(calculations[cf.offset_val])
-        return matches
+        if (self.rhythm_filter is not None and
+                not self.rhythm_filter.matches(rhythm)):
+            return False
+        for cf in self.calc_filters:
+            if not cf.matches(calculations[cf.offset_val]):
+                return False
+        return True
+
+    def matches_vec(self, rhythms:np.ndarray, metrics:list[np.ndarray]):
+        """
+        Return a boolean array marking which of the given rhythms, and their
+        calculations, match all of self's filters.
+
+        Arguments:
+            rhythms (numpy.array): The integer representations of rhythms
+            metrics (list[numpy.array]): The calculated values associated
+                with the passed rhythms, one array per calculation indexed by
+                offset.
+
+        The result is cached until self's filters change, so evaluating this
+        filter again over the same rhythms and metrics (e.g., as part of
+        another OrFilter) returns the cached, read-only array.
+        """
+        if self._mask_cache is not None:
+            version, cached_rhythms, cached_metrics, mask = self._mask_cache
+            if (version == self._version and cached_rhythms is rhythms and
+                    cached_metrics is metrics):
+                return mask
+
+        # A single mask is narrowed in place by each calculation filter
+        if self.rhythm_filter is not None:
+            mask = self.rhythm_filter.matches_vec(rhythms)
+        else:
+            mask = np.ones(len(rhythms), dtype=bool)
+        for cf in self.calc_filters:
+            cf.matches_vec(metrics[cf.offset_val], out=mask)
+        mask.flags.writeable = False
+        self._mask_cache = (self._version, rhythms, metrics, mask)
+        return mask
     
     def get_name(self, spaces_off=0):
-        """Return a pretty name for this filter."""
+        """
+        Return a pretty name for this filter. The name is cached until self's
+        filters change.
+        """
+        if self._name_cache is not None:
+            version, cached_spaces_off, name = self._name_cache
+            if version == self._version and cached_spaces_off == spaces_off:
+                return name
+
         spfill = SP_FILL * 2
         name = 'AND:'
-        if hasattr(self, 'rhythm_filter'):
+        if self.rhythm_filter is not None:
             name = f'{name}\n{' ' * spaces_off}{spfill}{self.rhythm_filter.get_name()}'
-        if hasattr(self, 'calc_filters'):
-            for cf in self.calc_filters:
-                name = f'{name}\n{' ' * spaces_off}{spfill}{cf.get_name()}'
+        for cf in self.calc_filters:
+            name = f'{name}\n{' ' * spaces_off}{spfill}{cf.get_name()}'
+        self._name_cache = (self._version, spaces_off, name)
         return name
         
 
@@ -168,18 +283,25 @@ class OrFilter:
     def __init__(self):
         """Initialize empty OrFilter."""
         self.andfilters = []
+        # Bumped whenever an AndFilter is added; see get_version()
+        self._version = 0
+        # (version, sp_off, name) of the last get_name
+        self._name_cache = None
 
     @classmethod
     def from_andfilters(cls, andfilters:list[AndFilter]):
+        """Initialize with a list of AndFilters."""
         orfilter = cls()
-        orfilter.andfilters = andfilters
-
+        orfilter.andfilters = list(andfilters)
+        orfilter._version += 1
+        return orfilter
     
     @classmethod
     def from_json(cls, as_json):
         """Initialize from JSON-formatted data."""
         orfilter = cls()
         orfilter.andfilters = [AndFilter.from_json(af) for af in as_json]
+        orfilter._version += 1
         return orfilter
     
     def get_serializable(self):
@@ -188,16 +310,48 @@ class OrFilter:
 
     def add_filter(self, f:AndFilter):
         self.andfilters.append(f)
+        self._version += 1
 
-    def matches(self, rhythm:str, calculations:list):
-        matches = True
+    def get_version(self):
+        """
+        Return a value that changes whenever self, or any of its AndFilters,
+        changes, so that results computed with this filter can be cached.
+        """
+        return (self._version, tuple(af._version for af in self.andfilters))
+
+    def matches(self, rhythm:int, calculations:list):
+        """
+        Return True if the given rhythm, and its calculations, match any of
+        self's AndFilters.
+        """
+        return any(f.matches(rhythm, calculations)
+                   for f in self.andfilters)
+
+    def matches_vec(self, rhythms:np.ndarray, metrics:list[np.ndarray]):
+        """
+        Return a boolean array marking which of the given rhythms, and their
+        calculations, match any of self's AndFilters.
+        """
+        # AndFilter masks are cached and read-only, so they are ORed into a
+        # single new mask rather than stacked
+        mask = np.zeros(len(rhythms), dtype=bool)
         for f in self.andfilters:
-            matches = matches and f.matches(rhythm, calculations)
-        return matches
+            np.logical_or(mask, f.matches_vec(rhythms, metrics), out=mask)
+        return mask
 
     def get_name(self, sp_off=0):
-        """Return a pretty name for this filter."""
+        """
+        Return a pretty name for this filter. The name is cached until self,
+        or any of its AndFilters, changes.
+        """
+        version = self.get_version()
+        if self._name_cache is not None:
+            cached_version, cached_sp_off, name = self._name_cache
+            if cached_version == version and cached_sp_off == sp_off:
+                return name
+
         name = 'OR:'
         for f in self.andfilters:
             name = f'{name}\n{' ' * sp_off}{SP_FILL}{f.get_name(sp_off)}'
+        self._name_cache = (version, sp_off, name)
         return name
\ No newline at end of file
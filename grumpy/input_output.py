@@ -1,17 +1,62 @@
-import csv, json
+import collections
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 from musicscore import *
 from musicxml.xmlelement.xmlelement import *
-from .rhythm_calculator import RhythmCalculator, Offsets
+from .rhythm_calculator import RhythmCalculator, Offsets, BATCH_SIZE
 from .filtration import OrFilter
 
 # For write_rhythms_musicxml
 partno = 0
 
+# Column names of written rhythms: the rhythm, then each Offsets calculation
+CSV_HEADER = ('Rhythm', *Offsets.__members__)
+# Same line terminator as the csv module's default dialect
+CSV_LINE_TERMINATOR = '\r\n'
+# Newline and indentation of the rhythm dictionaries in a JSON file's list
+JSON_NEWLINE = '\n' + ' ' * 4
+# Number of measures rendered at once, by one worker, for the MusicXML writer
+MUSICXML_BATCH_SIZE = 64
+# As written by musicscore's Score.export_xml
+MUSICXML_DECLARATION = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<!DOCTYPE score-partwise PUBLIC
+    "-//Recordare//DTD MusicXML 4.0 Partwise//EN"
+    "http://www.musicxml.org/dtds/partwise.dtd">
+"""
+# Where the measures of a MusicXML file's single part start and end
+MUSICXML_MEASURE_START = '    <measure '
+MUSICXML_PART_END = '  </part>'
+
 ########## CSV ##########
 def get_csv_header():
-    csv_header = [name for name in Offsets.__members__]
-    csv_header.insert(0, 'Rhythm')
-    return csv_header
+    return list(CSV_HEADER)
+
+def get_rhythms_to_write(rc:RhythmCalculator, rhythms=None):
+    """
+    Return param rhythms, or all of rc's rhythms if rhythms is None, as a
+    numpy array of unsigned integers.
+    """
+    if rhythms is None:
+        return rc.get_rhythms_array()
+    return np.asarray(rhythms, dtype=np.uint64)
+
+def iter_rhythm_batches(rc:RhythmCalculator, rhythms=None,
+                        batch_size:int=BATCH_SIZE):
+    """
+    Yield param rhythms, or all of rc's rhythms if rhythms is None, as numpy
+    arrays of unsigned integers of at most batch_size rhythms each. Param
+    rhythms may be any iterable of rhythms, including a generator.
+    """
+    if rhythms is None or isinstance(rhythms, np.ndarray):
+        rhythms_to_write = get_rhythms_to_write(rc, rhythms)
+        for start in range(0, len(rhythms_to_write), batch_size):
+            yield rhythms_to_write[start:start + batch_size]
+    else:
+        for batch in itertools.batched(rhythms, batch_size):
+            yield np.fromiter(batch, dtype=np.uint64, count=len(batch))
 
 def write_rhythms_csv(rc:RhythmCalculator, filename:str, rhythms=None):
     """
@@ -22,25 +67,21 @@ def write_rhythms_csv(rc:RhythmCalculator, filename:str, rhythms=None):
     Args:
         rc (RhythmCalculator)
         filename (str): The file to write to.
-        rhythms (None | list[int]): Optional subset of rc.rhythms; if included,
-            only these rhythms and their values are written.
+        rhythms (None | Iterable[int]): Optional subset of rc.rhythms; if
+            included, only these rhythms and their values are written.
     """
     # outfile = get_file_path(filename, OUTPUT_DIR)
     with open(filename, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        header = get_csv_header()
-        writer.writerow(header)
-        if rhythms == None:
-            rhythms_to_write = rc.rhythms
-        else:
-            rhythms_to_write = rhythms
-        for rhythm in rhythms_to_write:
-            row = list(rc.metrics[rhythm])
-            rhythm_as_string = RhythmCalculator.rhythm_to_string(rhythm,
-                                                                 rc.num_divs,
-                                                                 rc.time_map)
-            row.insert(0, rhythm_as_string)
-            writer.writerow(row)
+        csvfile.write(','.join(CSV_HEADER) + CSV_LINE_TERMINATOR)
+        # Every column of a batch is formatted by numpy, then its rows are
+        # joined and written at once; rhythms and numbers never need quoting
+        for batch in iter_rhythm_batches(rc, rhythms):
+            columns = [RhythmCalculator.rhythms_to_strings(batch, rc.num_divs,
+                                                           rc.time_map)]
+            columns += [values[batch].astype(str).tolist()
+                        for values in rc.metrics]
+            lines = [','.join(row) for row in zip(*columns)]
+            csvfile.write(CSV_LINE_TERMINATOR.join(lines) + CSV_LINE_TERMINATOR)
 
 ########## JSON ##########
 def get_rhythm_dict(values:list):
@@ -48,12 +89,7 @@ def get_rhythm_dict(values:list):
     Given a list of a rhythm and its calculated metrics, return a dictionary
     mapping the name of each metric to its value.
     """
-    keys = [name for name in Offsets.__members__]
-    keys.insert(0, 'Rhythm')
-    rhythm_dict = {}
-    for (key, val) in zip(keys, values):
-        rhythm_dict[key] = val
-    return rhythm_dict
+    return dict(zip(CSV_HEADER, values))
 
 def write_rhythms_json(rc:RhythmCalculator, filename:str, rhythms=None):
     """
@@ -64,57 +100,62 @@ def write_rhythms_json(rc:RhythmCalculator, filename:str, rhythms=None):
     Args:
         rc (RhythmCalculator):
         filename (str): The file to write to.
-        rhythms (None | list[int]): Optional subset of rc.rhythms; if included,
-            only these rhythms and their values are written.
+        rhythms (None | Iterable[int]): Optional subset of rc.rhythms; if
+            included, only these rhythms and their values are written.
     """
+    # The file is written one batch at a time, laid out as by
+    # json.dump(..., indent=4) of the list of all rhythm dictionaries
+    separator = '['
     with open(filename, 'w') as jsonfile:
-        json_objects = []
-        if rhythms == None:
-            rhythms_to_write = rc.rhythms
-        else:
-            rhythms_to_write = rhythms
-        for rhythm in rhythms_to_write:
-            json_object = list(rc.metrics[rhythm])
-            rhythm_as_string = RhythmCalculator.rhythm_to_string(rhythm,
+        for batch in iter_rhythm_batches(rc, rhythms):
+            rhythm_strings = RhythmCalculator.rhythms_to_strings(batch,
                                                                  rc.num_divs,
                                                                  rc.time_map)
-            json_object.insert(0, rhythm_as_string)
-            json_object = get_rhythm_dict(json_object)
-            json_objects.append(json_object)
-        json.dump(json_objects, jsonfile, indent=4)
+            metrics = zip(*rc.get_metrics_lists(batch))
+            json_objects = [json.dumps(get_rhythm_dict((rhythm_as_string, *row)),
+                                       indent=4).replace('\n', JSON_NEWLINE)
+                            for (rhythm_as_string, row)
+                            in zip(rhythm_strings, metrics)]
+            jsonfile.write(separator + JSON_NEWLINE)
+            jsonfile.write((',' + JSON_NEWLINE).join(json_objects))
+            separator = ','
+        jsonfile.write('[]' if separator == '[' else '\n]')
 
 ########## MusicXML ##########
-def write_rhythms_musicxml(rc:RhythmCalculator, filename:str, rhythms=None):
+def get_musicxml_batch(time_sig:tuple, num_divs:int, part_id:str,
+                       rhythms:list[int], rhythms_as_str:list[str],
+                       is_first:bool, is_last:bool):
     """
-    Write rhythms in MusicXML format to the given file in the output directory,
-    creating it if it doesn't exist and overwriting it if it does.
-    
+    Return the portion of a MusicXML file written for this batch of rhythms,
+    one measure per rhythm: the file's header if is_first, then the batch's
+    measures, then the file's closing tags if is_last. Only the last measure
+    of the last batch gets a final barline.
+
     Args:
-        rc (RhythmCalculator)
-        filename (str): The file to write to. A .xml extension must be present
-            for the file write to succeed.
-        rhythms (None | list[int]): Optional subset of rc.rhythms; if included,
-            only these rhythms are written. This function expects len(rhythms)
-            > 0.
+        time_sig (tuple[int, int]): The time signature of the measures.
+        num_divs (int): The number of subdivisions of a measure.
+        part_id (str): The id of the file's single part.
+        rhythms (list[int]): The rhythms, numbering the measures.
+        rhythms_as_str (list[str]): The undelimited string representations of
+            param rhythms.
+        is_first (bool): Whether this is the file's first batch.
+        is_last (bool): Whether this is the file's last batch.
     """
+    num_beats, beat_type = time_sig
     score = Score()
-    #part names must be unique within the run of a program
-    part = score.add_child(Part(f'p{partno}')) 
-    partno += 1
+    part = score.add_child(Part(part_id))
 
+    # Invariant across measures, so built once and shared by every measure
     time = Time()
-    time.signatures = [rc.get_num_beats(), rc.get_beat_type()]
-    qd = 4/(rc.get_beat_type()*(rc.num_divs/rc.get_num_beats()))
+    time.signatures = [num_beats, beat_type]
+    clef = Clef(sign='percussion')
+    qd = 4/(beat_type*(num_divs/num_beats))
+    # Chord arguments (midi, quarter duration) for each character of a rhythm
+    chord_args = {'0': (0, qd), '1': (77, qd)}
 
-    if rhythms == None:
-        rhythms_to_write = rc.rhythms
-    else:
-        rhythms_to_write = rhythms
-
-    for rhythm in rhythms_to_write:
+    for (rhythm, rhythm_as_str) in zip(rhythms, rhythms_as_str):
         # Set up the measure
         measure = part.add_child(Measure(number=rhythm, time=time))
-        clef = Clef(sign='percussion')
         staff = Staff(number=1, clef=clef)
         measure.add_child(staff)
         voice = staff.add_child(Voice(number=1))
@@ -128,19 +169,74 @@ def write_rhythms_musicxml(rc:RhythmCalculator, filename:str, rhythms=None):
         attributes.add_child(staff_details)
 
         # Add the rhythm to the measure
-        rhythm_as_str = RhythmCalculator.get_undelimited_bin(rhythm, rc.num_divs)
-        events = [char for char in rhythm_as_str]
-
-        for event in events:
+        for event in rhythm_as_str:
             beat = voice.add_child(Beat(quarter_duration=qd))
-            if (event == '0'):
-                chord = Chord(0, qd)
-                beat.add_child(chord) 
-            else:
-                chord = Chord(77, qd)
-                beat.add_child(chord)
+            beat.add_child(Chord(*chord_args[event]))
 
-    score.export_xml(filename)
+    # Finalizing the part first keeps the score from adding a final barline
+    # to the last measure of this batch
+    if not is_last:
+        part.finalize()
+    text = score.to_string()
+    # Free the part id, to be used again by the file's next batch
+    part.id_.delete()
+
+    start = 0 if is_first else text.index(MUSICXML_MEASURE_START)
+    end = len(text) if is_last else text.rindex(MUSICXML_PART_END)
+    return text[start:end]
+
+def iter_musicxml_batches(rc:RhythmCalculator, part_id:str, rhythms=None):
+    """
+    Yield the arguments of get_musicxml_batch for each batch of at most
+    MUSICXML_BATCH_SIZE of param rhythms, or of all of rc's rhythms if rhythms
+    is None, in the order they are written.
+    """
+    time_sig = (rc.get_num_beats(), rc.get_beat_type())
+    batches = iter_rhythm_batches(rc, rhythms, MUSICXML_BATCH_SIZE)
+    batch = next(batches)
+    is_first = True
+    # One batch of lookahead tells which batch is the last
+    for next_batch in itertools.chain(batches, [None]):
+        rhythms_as_str = RhythmCalculator.get_undelimited_bins(batch,
+                                                               rc.num_divs)
+        yield (time_sig, rc.num_divs, part_id, batch.tolist(), rhythms_as_str,
+               is_first, next_batch is None)
+        batch = next_batch
+        is_first = False
+
+def write_rhythms_musicxml(rc:RhythmCalculator, filename:str, rhythms=None):
+    """
+    Write rhythms in MusicXML format to the given file in the output directory,
+    creating it if it doesn't exist and overwriting it if it does. Batches of
+    MUSICXML_BATCH_SIZE measures are rendered in parallel worker processes and
+    written in order.
+    
+    Args:
+        rc (RhythmCalculator)
+        filename (str): The file to write to. A .xml extension must be present
+            for the file write to succeed.
+        rhythms (None | Iterable[int]): Optional subset of rc.rhythms; if
+            included, only these rhythms are written. This function expects
+            len(rhythms) > 0.
+    """
+    global partno
+    #part names must be unique within the run of a program
+    part_id = f'p{partno}'
+    partno += 1
+
+    num_workers = os.cpu_count() or 1
+    with (open(filename, 'w') as xmlfile,
+          ProcessPoolExecutor(max_workers=num_workers) as executor):
+        xmlfile.write(MUSICXML_DECLARATION)
+        # At most a few batches per worker are in flight at once, so that
+        # rendered batches don't pile up in memory ahead of the write
+        pending = collections.deque()
+        for args in iter_musicxml_batches(rc, part_id, rhythms):
+            pending.append(executor.submit(get_musicxml_batch, *args))
+            if len(pending) > num_workers * 2:
+                xmlfile.write(pending.popleft().result())
+        while pending:
+            xmlfile.write(pending.popleft().result())
 
 ########## Session persistence ##########
 class GrumpySession:
@@ -155,6 +251,8 @@ class GrumpySession:
     def __init__(self, rc:RhythmCalculator):
         self.rhythm_calculator = rc
         self.filters = []
+        # filter index -> (filter, filter version, result)
+        self._filter_results = {}
 
     @classmethod
     def from_file(cls, filename:str):
@@ -173,9 +271,28 @@ class GrumpySession:
         return self_dict
 
     def add_filter(self, f:OrFilter):
-        """Add a filter to this session."""
+        """
+        Add a filter to this session. Raise ValueError, without adding it, if
+        the filter doesn't fit the session's rhythms.
+        """
+        self.rhythm_calculator.attach_filter(f)
         self.filters.append(f)
 
+    def get_filter_result(self, f_idx:int):
+        """
+        Return the list of rhythms matching the filter at param f_idx. The
+        result is cached until that filter changes, so saving it in several
+        formats filters the rhythms only once.
+        """
+        f = self.filters[f_idx]
+        version = f.get_version()
+        cached = self._filter_results.get(f_idx)
+        if cached is not None and cached[0] is f and cached[1] == version:
+            return cached[2]
+        result = self.rhythm_calculator.get_filter_result(f)
+        self._filter_results[f_idx] = (f, version, result)
+        return result
+
     def list_filters(self, spaces_off=0):
         """List the filters of this session in a human-friendly format."""
         for i, f in enumerate(self.filters):
@@ -1,4 +1,5 @@
-import os, shutil
+import os, functools, itertools
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum, unique, auto
 import numpy as np
 from .synpy import *
@@ -6,8 +7,8 @@ from .filtration import OrFilter
 
 SIG_DIGS = 3
 BEAT_DELIMITER = '_'
-RHY_DIR_PATH = os.path.join(os.path.curdir, 'rhy')
-RHY_FILE_PATH = os.path.join(RHY_DIR_PATH, 'temp.rhy')
+# Number of rhythms processed at once by batched calculations and writers
+BATCH_SIZE = 4096
 
 @unique
 class Offsets(Enum):
@@ -25,6 +26,14 @@ class Offsets(Enum):
     TOB = auto()
     # Add any new offsets here
 
+# Offsets calculated by SynPy, in the order returned by calc_synpy_metrics
+SYNPY_OFFSETS = (Offsets.LHL, Offsets.PRS, Offsets.TMC, Offsets.TOB)
+
+# numpy dtype in which each calculation is stored; float32 unless listed here.
+# SynPy values aren't rounded, so are kept at full precision.
+METRIC_DTYPES = {Offsets.Density: np.int16,
+                 **{offset: np.float64 for offset in SYNPY_OFFSETS}}
+
 class RhythmCalculator:
     """
     A RhythmCalculator instance is defined by its of measure, in terms of
@@ -46,12 +55,14 @@ class RhythmCalculator:
             number of subdivisons (num_divs). Rhythms are represented by the 
             binary form of an integer, where 1 indicates an event and 0 
             indicates no event.
-        rhythms (list[int]): A list of all rhythms possible in a measure. 
-            Rhythms are represented by the binary form of an integer, where 1 
-            indicates an event and 0 indicates no event, read from most 
-            significant bit to least significant bit.
-        metrics (numpy.array): A 2D array of the calculated metrics for each 
-            generated rhythm.
+        rhythms (range): All rhythms possible in a measure. Rhythms are
+            represented by the binary form of an integer, where 1 indicates an
+            event and 0 indicates no event, read from most significant bit to
+            least significant bit.
+        metrics (list[numpy.array]): The calculated metrics of every
+            generated rhythm, as one array per calculation indexed by the
+            calculation's Offsets value. Each array holds one value per
+            rhythm, with the dtype given by METRIC_DTYPES.
     """
 
     def __init__(self, num_divs:int, time_map:list, time_sig:tuple):
@@ -59,8 +70,11 @@ class RhythmCalculator:
         self.time_map = time_map
         self.time_sig = time_sig
         self.num_rhythms = 2**num_divs
-        self.rhythms = list(range(self.num_rhythms))
-        self.metrics = np.empty((self.num_rhythms, len(Offsets)), order='C')
+        self.rhythms = range(self.num_rhythms)
+        self._rhythms_array = None
+        self.metrics = [np.empty(self.num_rhythms,
+                                 dtype=METRIC_DTYPES.get(offset, np.float32))
+                        for offset in Offsets]
         self.calc_metrics()
 
     @classmethod
@@ -84,100 +98,139 @@ class RhythmCalculator:
 
         rhythm_as_bin = RhythmCalculator.get_undelimited_bin(rhythm,
                                                              self.num_divs)
-        bits = list(rhythm_as_bin)
-        velocity_seq = 'V{'
-        for bit in bits:
-            velocity_seq = velocity_seq + bit + ','
-        velocity_seq = velocity_seq[:-1] + '}'
+        velocity_seq = 'V{' + ','.join(rhythm_as_bin) + '}'
 
         as_rhy_str = time_sig_str + '\n' + velocity_seq
         return as_rhy_str
 
-    def get_density(self, rhythm:int):
-        return rhythm.bit_count()
-
-    def get_npvi(self, rhythm:int):
-        # zero or one events in rhythm
-        if (rhythm == 0 or (rhythm.bit_count() == 1)):
-            return 0
-
-        # strip leading zeroes
-        s = bin(rhythm)
-        s = s.lstrip('-0b')
-
-        # put each bit as an element of a list of ints
-        bits = list(s)
-        bits = list(map(int, bits))
-
-        # list of durations between notes
-        durations = []
-        duration = 1
-        # we already know the first bit is 1 as we stripped leading 0s
-        for bit in bits[1:]:
-            # start of a new note
-            if (bit == 1):
-                durations.append(duration)
-                duration = 1
-            # bit is 0 - continuation of previous note
-            else:
-                duration += 1
-        durations.append(duration) #the last duration
-
-        # list of summing terms
-        pv = []
-        for (d0, d1) in zip(durations, durations[1:]):
-            val = (abs(d0 - d1)/(d0 + d1))*200
-            pv.append(val)
-
-        npvi = sum(pv)/len(pv)
-        return npvi
-
-    def get_synpy_result(self, rhythm:int, model:str):
-        output = syncopation.calculate_syncopation(model, RHY_FILE_PATH)
+    def get_densities(self, rhythms:np.ndarray):
+        """Return the density (number of events) of each of param rhythms."""
+        return np.bitwise_count(rhythms)
+
+    def get_npvis(self, rhythms:np.ndarray):
+        """
+        Return the nPVI (durational variability) of each of param rhythms.
+        Rhythms with zero or one events have an nPVI of 0.
+        """
+        # one row per rhythm, one column per subdivision, most significant
+        # bit first
+        bits = RhythmCalculator.get_bit_array(rhythms, self.num_divs)
+
+        # positions of every event, ordered by rhythm then position
+        rows, cols = np.nonzero(bits)
+        same_row = rows[1:] == rows[:-1]
+
+        # durations between events; the last event of a rhythm lasts until
+        # the end of the measure
+        next_cols = np.append(cols[1:], self.num_divs)
+        next_cols[:-1][~same_row] = self.num_divs
+        durations = next_cols - cols
+
+        # summing terms for each pair of consecutive durations in a rhythm
+        d0, d1 = durations[:-1][same_row], durations[1:][same_row]
+        pv = (np.abs(d0 - d1)/(d0 + d1))*200
+        pair_rows = rows[:-1][same_row]
+
+        sums = np.bincount(pair_rows, weights=pv, minlength=len(rhythms))
+        counts = np.bincount(pair_rows, minlength=len(rhythms))
+        npvis = np.zeros(len(rhythms))
+        np.divide(sums, counts, out=npvis, where=(counts > 0))
+        return npvis
+
+    @staticmethod
+    def to_barlist(rhythm:int, num_divs:int, time_sig:tuple):
+        """
+        Return a SynPy BarList holding rhythm as its only bar, equivalent to
+        parsing the output of to_rhy without a round trip through a file.
+        """
+        rhythm_as_bin = RhythmCalculator.get_undelimited_bin(rhythm, num_divs)
+        velocity_seq = music_objects.VelocitySequence(
+            [float(bit) for bit in rhythm_as_bin])
+        time_signature = RhythmCalculator.get_time_signature(
+            f'{time_sig[0]}/{time_sig[1]}')
+        bars = music_objects.BarList()
+        bars.append(music_objects.Bar(velocity_seq, time_signature))
+        return bars
+
+    @staticmethod
+    @functools.cache
+    def get_time_signature(time_sig_str:str):
+        """
+        Return the SynPy TimeSignature for time_sig_str, e.g., '4/4'. It is
+        shared by every bar of that time signature, as constructing one
+        reloads SynPy's time signature table from disk.
+        """
+        return music_objects.TimeSignature(time_sig_str)
+
+    @staticmethod
+    def get_synpy_result(bars:music_objects.BarList, model):
+        output = syncopation.calculate_syncopation(model, bars)
         return output['summed_syncopation']
 
-    def get_lhl(self, rhythm:int):
-        lhl = self.get_synpy_result(rhythm, LHL)
+    @staticmethod
+    def get_lhl(bars:music_objects.BarList):
+        lhl = RhythmCalculator.get_synpy_result(bars, LHL)
         # SynPy returns -1 for no syncopation - correct to 0
         if (lhl == -1):
             lhl = 0
         return lhl
     
-    def get_prs(self, rhythm:int):
-        return self.get_synpy_result(rhythm, PRS)
+    @staticmethod
+    def get_prs(bars:music_objects.BarList):
+        return RhythmCalculator.get_synpy_result(bars, PRS)
     
-    def get_tmc(self, rhythm:int):
-        return self.get_synpy_result(rhythm, TMC)
+    @staticmethod
+    def get_tmc(bars:music_objects.BarList):
+        return RhythmCalculator.get_synpy_result(bars, TMC)
     
-    def get_tob(self, rhythm:int):
-        return self.get_synpy_result(rhythm, TOB)
+    @staticmethod
+    def get_tob(bars:music_objects.BarList):
+        return RhythmCalculator.get_synpy_result(bars, TOB)
     
-    def calc_all(self, rhythm:int):
-        """
-        Calculate the value of each computational model, as defined in Offsets,
-        for param rhythm, populating self.metrics
-        """
-        rhydata = self.to_rhy(rhythm)
-        with open(RHY_FILE_PATH, 'w') as rhyfile:
-            rhyfile.write(rhydata)
-        self.metrics[rhythm][Offsets.Density.value] = self.get_density(rhythm)
-        self.metrics[rhythm][Offsets.nPVI.value] = round(self.get_npvi(rhythm),
-                                                         SIG_DIGS)
-        self.metrics[rhythm][Offsets.LHL.value] = self.get_lhl(rhythm)
-        self.metrics[rhythm][Offsets.PRS.value] = self.get_prs(rhythm)
-        self.metrics[rhythm][Offsets.TMC.value] = self.get_tmc(rhythm)
-        self.metrics[rhythm][Offsets.TOB.value] = self.get_tob(rhythm)
+    @staticmethod
+    def calc_synpy_metrics(rhythm:int, num_divs:int, time_sig:tuple):
+        """
+        Return the value of each SynPy model, in the order of SYNPY_OFFSETS,
+        for param rhythm. This doesn't depend on any RhythmCalculator state,
+        so calc_metrics can dispatch it to worker processes.
+        """
+        # parsed once, shared by every SynPy model
+        bars = RhythmCalculator.to_barlist(rhythm, num_divs, time_sig)
+        return (RhythmCalculator.get_lhl(bars), RhythmCalculator.get_prs(bars),
+                RhythmCalculator.get_tmc(bars), RhythmCalculator.get_tob(bars))
 
     def calc_metrics(self):
         """
         Calculate the value of each computational model, as defined in
         Offsets, for each rhythm of self, populating self.metrics
         """
-        if not os.path.exists(RHY_DIR_PATH):
-            os.mkdir(RHY_DIR_PATH)
-        for rhythm in self.rhythms:
-            self.calc_all(rhythm)
-        shutil.rmtree(RHY_DIR_PATH)
+        rhythms = self.get_rhythms_array()
+        self.metrics[Offsets.Density.value][:] = self.get_densities(rhythms)
+        # nPVI temporaries grow with the number of events, so are bounded by
+        # calculating BATCH_SIZE rhythms at a time
+        npvis = self.metrics[Offsets.nPVI.value]
+        for start in range(0, self.num_rhythms, BATCH_SIZE):
+            batch = rhythms[start:start + BATCH_SIZE]
+            npvis[start:start + len(batch)] = np.round(self.get_npvis(batch),
+                                                       SIG_DIGS)
+
+        # SynPy models are calculated per rhythm, spread over all CPU cores
+        calc = functools.partial(RhythmCalculator.calc_synpy_metrics,
+                                 num_divs=self.num_divs,
+                                 time_sig=self.time_sig)
+        chunksize = max(1, self.num_rhythms // ((os.cpu_count() or 1) * 4))
+        with ProcessPoolExecutor() as executor:
+            synpy_metrics = executor.map(calc, self.rhythms,
+                                         chunksize=chunksize)
+            # Results are copied into the metric arrays as they arrive, one
+            # batch at a time, rather than collected first; a model's None
+            # becomes NaN
+            for start in range(0, self.num_rhythms, BATCH_SIZE):
+                batch = np.array(list(itertools.islice(synpy_metrics,
+                                                       BATCH_SIZE)),
+                                 dtype=float)
+                for (offset, values) in zip(SYNPY_OFFSETS, batch.T):
+                    self.metrics[offset.value][start:start + len(batch)] = values
 
     @staticmethod
     def get_undelimited_bin(rhythm:int, num_divs:int):
@@ -190,6 +243,28 @@ class RhythmCalculator:
         #undelimited binary
         rhythm_as_str = format(rhythm,format_str) 
         return rhythm_as_str
+
+    @staticmethod
+    def get_bit_array(rhythms:np.ndarray, num_divs:int):
+        """
+        Return a 2D uint8 array of the bits of param rhythms: one row per
+        rhythm and one column per subdivision, most significant bit first.
+        """
+        # only the low bytes holding num_divs bits are unpacked
+        num_bytes = -(-num_divs // 8)
+        as_bytes = rhythms.astype('>u8').view(np.uint8).reshape(-1, 8)
+        bits = np.unpackbits(as_bytes[:, 8 - num_bytes:], axis=1)
+        return bits[:, 8 * num_bytes - num_divs:]
+
+    @staticmethod
+    def get_undelimited_bins(rhythms:np.ndarray, num_divs:int):
+        """
+        Return a list of the undelimited string representations of param
+        rhythms, as get_undelimited_bin, built in one pass over their bits.
+        """
+        chars = RhythmCalculator.get_bit_array(rhythms, num_divs) + ord('0')
+        chars = np.ascontiguousarray(chars)
+        return chars.view(f'S{num_divs}').ravel().astype(str).tolist()
         
     @staticmethod
     def rhythm_to_string(rhythm:int, num_divs:int, time_map:list[int]):
@@ -210,21 +285,80 @@ class RhythmCalculator:
 
         return rhythm_as_str
 
+    @staticmethod
+    def rhythms_to_strings(rhythms:np.ndarray, num_divs:int,
+                           time_map:list[int]):
+        """
+        Return a list of the string representations of param rhythms, with
+        delimited beats as in rhythm_to_string, built in one pass over a
+        character array.
+        """
+        chars = RhythmCalculator.get_bit_array(rhythms, num_divs) + ord('0')
+        if (len(time_map) > 1):
+            beat_starts = np.cumsum(time_map)[:-1]
+            chars = np.insert(chars, beat_starts, ord(BEAT_DELIMITER), axis=1)
+        chars = np.ascontiguousarray(chars)
+        return chars.view(f'S{chars.shape[1]}').ravel().astype(str).tolist()
+
+    def get_metrics_lists(self, rhythms:np.ndarray):
+        """
+        Return the calculated metrics of param rhythms as lists of Python
+        numbers, one list per calculation indexed by Offsets value. Floating
+        point values are converted from their shortest decimal representation,
+        e.g., 33.333 rather than the float32 value 33.33300018310547.
+        """
+        metrics_lists = []
+        for values in self.metrics:
+            values = values[rhythms]
+            if values.dtype == np.float32:
+                values = values.astype(str).astype(float)
+            metrics_lists.append(values.tolist())
+        return metrics_lists
+
+    def get_empty_rhythm(self):
+        """
+        Return the string representation of the rhythm of self with no
+        events, e.g., '000_000', which rhythm filters must fit.
+        """
+        return RhythmCalculator.rhythm_to_string(0, self.num_divs,
+                                                 self.time_map)
+
+    def attach_filter(self, f:OrFilter):
+        """
+        Check, once, that every rhythm filter of the given filter fits the
+        rhythms of self, so that matching needn't check each rhythm's length.
+        Raise ValueError if a rhythm filter doesn't fit.
+        """
+        empty_rhythm = self.get_empty_rhythm()
+        for af in f.andfilters:
+            rf = af.rhythm_filter
+            if rf is not None and not rf.fits(empty_rhythm):
+                raise ValueError(f'Rhythm filter {rf.pattern} does not fit '
+                                 f'rhythms of the form {empty_rhythm}')
+
     def get_filter_result(self, f:OrFilter):
         """
         Return a list of rhythms, in integer form, that satisfy the given
-        filter.
-        """
-        matching_rhythms = []
-        for rhythm in self.rhythms:
-            rhythm_as_str = RhythmCalculator.rhythm_to_string(rhythm,
-                                                              self.num_divs,
-                                                              self.time_map)
-            matches = f.matches(rhythm_as_str, self.metrics[rhythm])
-            if matches:
-                matching_rhythms.append(rhythm)
-        return matching_rhythms
+        filter. Raise ValueError if the filter doesn't fit self's rhythms (see
+        attach_filter).
+        """
+        self.attach_filter(f)
+        rhythms = self.get_rhythms_array()
+        mask = f.matches_vec(rhythms, self.metrics)
+        return np.flatnonzero(mask).tolist()
     
+    def get_rhythms_array(self):
+        """
+        Return self's rhythms as a read-only numpy array of unsigned integers.
+        The array is built on first use and then shared, so that filters can
+        recognise it and reuse their cached results.
+        """
+        if self._rhythms_array is None:
+            dtype = np.uint64 if self.num_divs > 32 else np.uint32
+            self._rhythms_array = np.arange(self.num_rhythms, dtype=dtype)
+            self._rhythms_array.flags.writeable = False
+        return self._rhythms_array
+
     def get_num_beats(self):
         """Return the number of beats in this measure."""
         return self.time_sig[0]